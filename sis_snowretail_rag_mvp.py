@@ -18,13 +18,20 @@
 # =========================================================
 # 基本ライブラリ
 import streamlit as st
-import pandas as pd
+import numpy as np
 import json
 import time
+import asyncio
 
 # Streamlitの設定
 st.set_page_config(layout="wide")
 
+# 並行処理ライブラリ
+from concurrent.futures import ThreadPoolExecutor
+
+# キャッシュ用ライブラリ
+from functools import lru_cache
+
 # Snowflake関連ライブラリ
 from snowflake.snowpark.context import get_active_session
 from snowflake.cortex import Complete as CompleteText
@@ -42,6 +49,68 @@ COMPLETE_MODELS = [
     "snowflake-llama-3.3-70b"
 ]
 
+# プロンプトに含める会話履歴の最大ターン数
+# 履歴全体を毎回送るとトークン数がターン数に比例して増え続けるため、
+# 直近のターンだけをコンテキストとして使用します
+MAX_HISTORY_TURNS = 10
+
+# セマンティックキャッシュの設定
+# 類似度がこの閾値以上の過去の質問には、キャッシュ済みの回答を再利用します
+SEM_CACHE_THRESHOLD = 0.9
+SEM_CACHE_MAX_ENTRIES = 128
+EMBED_MODEL = "e5-base-v2"
+
+# リランキングの設定
+# Cortex Searchから候補を多めに取得し、質問との埋め込み類似度で
+# 上位だけをコンテキストに採用することで回答の精度を高めます
+RERANK_CANDIDATES = 20
+RERANK_TOP_K = 3
+RERANK_SCORE_TTL = 900  # スコアキャッシュの有効期間（秒）
+
+# 回答の再生成の設定
+# 再生成された候補はメッセージごとのプールに保持され、
+# 一度生成した候補間の切り替えはモデルを呼び直さずに行えます
+REGENERATE_MAX_CANDIDATES = 4
+REGENERATE_TEMPERATURE = 0.8
+
+# RAG回答生成用のプロンプトテンプレート
+# リクエストごとに組み立て直さないよう、モジュールレベルで定義します
+RAG_PROMPT_TEMPLATE = """
+あなたはスノーリテールの社内アシスタントです。
+以下の文脈を参考に、ユーザーからの質問に日本語で回答してください。
+わからない場合は、その旨を正直に伝えてください。
+
+文脈:
+{context}
+
+質問: {prompt}
+"""
+
+# コンテキストに含める参考文書1件分のフォーマット
+RAG_DOC_FORMAT = """
+タイトル: {title}
+種類: {document_type}
+部署: {department}
+内容: {chunked_content}
+---
+"""
+
+# 過去メッセージの参考ドキュメントのプレビュー文字数
+# 履歴の全文Markdownを毎回描画し直すと長い会話で再実行が重くなるため、
+# 最新メッセージ以外は冒頭のみを表示します（全文はセッション状態に保持）
+HISTORY_DOC_PREVIEW_CHARS = 500
+
+# COMPLETE呼び出しのタイムアウト（秒）
+# モデルからの応答が返らない場合にスクリプトが無期限に
+# ブロックされ続けるのを防ぎます
+COMPLETE_TIMEOUT = 30
+
+# ストリーミング表示の更新頻度の設定
+# トークンごとに画面を更新すると描画コストが大きいため、
+# 50ミリ秒または8文字たまるごとにまとめて表示します（約20Hz）
+STREAM_FLUSH_INTERVAL = 0.05
+STREAM_FLUSH_CHARS = 8
+
 # =========================================================
 # Snowflake接続
 # =========================================================
@@ -49,6 +118,233 @@ COMPLETE_MODELS = [
 # Snowflakeセッションの取得
 snowflake_session = get_active_session()
 
+# =========================================================
+# キャッシュ付きヘルパー関数
+# =========================================================
+# Streamlitは操作のたびにスクリプト全体を再実行するため、
+# 毎回変わらないSnowflakeへの問い合わせ結果はキャッシュして
+# ウェアハウスへのラウンドトリップを削減します。
+
+@st.cache_resource
+def _get_executor():
+    """独立したSnowflake I/Oを並行実行するためのスレッドプールを返します。"""
+    return ThreadPoolExecutor(max_workers=4)
+
+@st.cache_resource
+def _get_db_schema():
+    """現在のデータベースとスキーマを取得します（セッション中は不変のためキャッシュ）。"""
+    row = snowflake_session.sql("SELECT CURRENT_DATABASE(), CURRENT_SCHEMA()").collect()[0]
+    return row['CURRENT_DATABASE()'], row['CURRENT_SCHEMA()']
+
+@st.cache_resource
+def _get_search_service():
+    """Cortex Search Serviceのハンドルを取得します（プロセスごとに1回だけ構築）。
+
+    Rootオブジェクトの構築とスキーマメタデータの取得を初回に済ませ、
+    以降の質問ではキャッシュ済みのハンドルを再利用します。
+    """
+    root = Root(snowflake_session)
+    current_database, current_schema = _get_db_schema()
+    return (
+        root.databases[current_database]
+        .schemas[current_schema]
+        .cortex_search_services["snow_retail_search_service"]
+    )
+
+@st.cache_data(ttl=3600)
+def _get_filter_options():
+    """部署とドキュメントタイプの一覧を取得します（1時間キャッシュ）。
+
+    2回のDISTINCTスキャンを1回のGROUP BYスキャンにまとめ、
+    テーブルの読み取りを半減させます。
+    """
+    rows = snowflake_session.sql("""
+        SELECT department, document_type FROM snow_retail_documents
+        GROUP BY department, document_type
+    """).collect()
+    department_list = sorted({row['DEPARTMENT'] for row in rows})
+    document_type_list = sorted({row['DOCUMENT_TYPE'] for row in rows})
+    return department_list, document_type_list
+
+@st.cache_data
+def _build_filter(selected_departments, selected_document_types):
+    """Cortex Search用の検索フィルターを構築します（選択はタプルで受け取りキャッシュ）。"""
+    # フィルター未指定（既定のホットパス）は即座に抜けます
+    if not selected_departments and not selected_document_types:
+        return None
+
+    filter_conditions = []
+    for field, values in (
+        ("department", selected_departments),
+        ("document_type", selected_document_types)
+    ):
+        if not values:
+            continue
+        conditions = [{"@eq": {field: value}} for value in values]
+        filter_conditions.append(conditions[0] if len(conditions) == 1 else {"@or": conditions})
+
+    if not filter_conditions:
+        return None
+    return filter_conditions[0] if len(filter_conditions) == 1 else {"@and": filter_conditions}
+
+def _complete_with_timeout(model, prompt, **kwargs):
+    """COMPLETE呼び出しをワーカースレッドで実行し、タイムアウトを設けます。
+
+    ストリーミングの場合は接続確立（最初のトークンが返るまで）に
+    タイムアウトが適用されます。
+    """
+    return asyncio.run(
+        asyncio.wait_for(
+            asyncio.to_thread(CompleteText, model, prompt, **kwargs),
+            timeout=COMPLETE_TIMEOUT
+        )
+    )
+
+def _throttled_stream(stream):
+    """ストリーミングのチャンクをまとめ、UI更新を約20Hzに抑えるジェネレーターです。"""
+    buffer = ""
+    last_flush = time.monotonic()
+    for chunk in stream:
+        buffer += chunk
+        now = time.monotonic()
+        if len(buffer) >= STREAM_FLUSH_CHARS or now - last_flush >= STREAM_FLUSH_INTERVAL:
+            yield buffer
+            buffer = ""
+            last_flush = now
+    # 残りのチャンクを出力
+    if buffer:
+        yield buffer
+
+@lru_cache(maxsize=512)
+def _embed_text_cached(text):
+    """テキストの埋め込みをタプルで取得します（同一テキストはプロセス内キャッシュから返却）。"""
+    row = snowflake_session.sql(
+        f"SELECT SNOWFLAKE.CORTEX.EMBED_TEXT_768('{EMBED_MODEL}', ?) AS EMBEDDING",
+        params=[text]
+    ).collect()[0]
+    # lru_cacheで保持できるようハッシュ可能なタプルとして返します
+    return tuple(row['EMBEDDING'])
+
+def _embed_text(text):
+    """テキストの埋め込みベクトルをNumPy配列として取得します。"""
+    return np.asarray(_embed_text_cached(text), dtype=np.float32)
+
+def _embed_texts_batch(texts):
+    """複数テキストの埋め込みベクトルを1回のクエリでまとめて取得します。"""
+    rows = snowflake_session.sql(
+        f"""
+        SELECT f.index AS IDX,
+               SNOWFLAKE.CORTEX.EMBED_TEXT_768('{EMBED_MODEL}', f.value::string) AS EMBEDDING
+        FROM TABLE(FLATTEN(INPUT => PARSE_JSON(?))) f
+        ORDER BY f.index
+        """,
+        params=[json.dumps(texts)]
+    ).collect()
+    return [np.asarray(row['EMBEDDING'], dtype=np.float32) for row in rows]
+
+# リランキングスコアのキャッシュ: (質問, チャンク) -> (スコア, 記録時刻)
+_rerank_score_cache = {}
+
+def _rerank_results(prompt, results):
+    """検索候補を質問との埋め込み類似度でリランキングし、上位RERANK_TOP_K件を返します。"""
+    if len(results) <= RERANK_TOP_K:
+        return list(results)
+
+    # 期限切れのスコアをキャッシュから削除
+    now = time.monotonic()
+    for key, (_, recorded_at) in list(_rerank_score_cache.items()):
+        if now - recorded_at >= RERANK_SCORE_TTL:
+            del _rerank_score_cache[key]
+
+    chunks = [result["chunked_content"] for result in results]
+    keys = [(prompt, chunk) for chunk in chunks]
+
+    # キャッシュにないチャンクだけをまとめて埋め込み、類似度を一括計算
+    missing = [i for i, key in enumerate(keys) if key not in _rerank_score_cache]
+    if missing:
+        query_embedding = _embed_text(prompt)
+        chunk_matrix = np.stack(_embed_texts_batch([chunks[i] for i in missing]))
+        norms = np.linalg.norm(chunk_matrix, axis=1) * np.linalg.norm(query_embedding)
+        scores = chunk_matrix @ query_embedding / norms
+        for i, score in zip(missing, scores):
+            _rerank_score_cache[keys[i]] = (float(score), now)
+
+    ranked = sorted(
+        range(len(results)),
+        key=lambda i: _rerank_score_cache[keys[i]][0],
+        reverse=True
+    )
+    return [results[i] for i in ranked[:RERANK_TOP_K]]
+
+# =========================================================
+# セマンティックキャッシュ
+# =========================================================
+# 同じ質問や言い換えられた質問に対して、Cortex Search + COMPLETEの
+# パイプライン（数秒）を再実行せず、過去の回答を即座に返します。
+# キャッシュは (埋め込みベクトル, 質問, 回答, 参考ドキュメント) のリストとして
+# セッション状態に保持します。
+
+def _advance_candidate(message):
+    """次の回答候補に切り替えます。プールに未生成の候補がなければ新たに生成します。"""
+    candidates = message.setdefault("candidates", [message["content"]])
+    current = message.get("cand_idx", 0)
+    if current + 1 < len(candidates):
+        # 生成済みの候補があればモデルを呼ばずに切り替え
+        message["cand_idx"] = current + 1
+    elif len(candidates) < REGENERATE_MAX_CANDIDATES:
+        # 温度を上げて新しい候補を生成し、プールに追加
+        candidates.append(_complete_with_timeout(
+            complete_model,
+            message["gen_prompt"],
+            options={"temperature": REGENERATE_TEMPERATURE}
+        ))
+        message["cand_idx"] = len(candidates) - 1
+    else:
+        # 上限に達したら最初の候補に戻る
+        message["cand_idx"] = 0
+    message["content"] = candidates[message["cand_idx"]]
+
+def _pool_documents(relevant_docs):
+    """参考ドキュメントをターン間で共有するプールに登録し、IDのリストを返します。
+
+    同じドキュメントが複数ターンで参照されても、実体はプールに1つだけ
+    保持され、各メッセージはIDのみを持ちます。
+    """
+    doc_cache = st.session_state.setdefault("rag_doc_cache", {})
+    for doc in relevant_docs:
+        doc_cache[doc["document_id"]] = doc
+    return [doc["document_id"] for doc in relevant_docs]
+
+def _sem_cache_lookup(query_embedding):
+    """セマンティックキャッシュを検索し、類似度が閾値以上のエントリを返します。"""
+    cache = st.session_state.get("sem_cache", [])
+    if not cache:
+        return None
+    # キャッシュ済みの埋め込みを1つの行列にまとめ、コサイン類似度を一括計算
+    cached_matrix = np.stack([entry["embedding"] for entry in cache])
+    norms = np.linalg.norm(cached_matrix, axis=1) * np.linalg.norm(query_embedding)
+    similarities = cached_matrix @ query_embedding / norms
+    best_index = int(np.argmax(similarities))
+    if similarities[best_index] >= SEM_CACHE_THRESHOLD:
+        # ヒットしたエントリを末尾に移動（LRU: 最近使われたものを残す）
+        entry = cache.pop(best_index)
+        cache.append(entry)
+        return entry
+    return None
+
+def _sem_cache_store(query_embedding, prompt, response, relevant_docs):
+    """質問と回答のペアをセマンティックキャッシュに追加します。"""
+    cache = st.session_state.setdefault("sem_cache", [])
+    cache.append({
+        "embedding": query_embedding,
+        "prompt": prompt,
+        "response": response,
+        "relevant_docs": relevant_docs
+    })
+    # 上限を超えた場合は最も古いエントリから削除
+    while len(cache) > SEM_CACHE_MAX_ENTRIES:
+        cache.pop(0)
+
 # =========================================================
 # UI関数
 # =========================================================
@@ -74,12 +370,10 @@ def render_simple_chatbot_page():
     # セッション状態の初期化
     if "messages" not in st.session_state:
         st.session_state.messages = []
-        st.session_state.chat_history = ""
-    
+
     # チャット履歴のクリアボタン
     if st.button("チャット履歴をクリア"):
         st.session_state.messages = []
-        st.session_state.chat_history = ""
         st.rerun()
     
     # チャット履歴の表示
@@ -91,21 +385,23 @@ def render_simple_chatbot_page():
     if prompt := st.chat_input("メッセージを入力してください"):
         # ユーザーメッセージの表示と履歴の更新
         st.session_state.messages.append({"role": "user", "content": prompt})
-        st.session_state.chat_history += f"User: {prompt}\n"
         with st.chat_message("user"):
             st.markdown(prompt)
-        
+
         try:
-            # Cortex Completeを使用して応答を生成
-            full_prompt = st.session_state.chat_history + "AI: "
-            response = CompleteText(complete_model, full_prompt)
-            
-            # 応答の表示と履歴の更新
-            st.session_state.messages.append({"role": "assistant", "content": response})
-            st.session_state.chat_history += f"AI: {response}\n"
+            # Cortex Completeを使用して応答をストリーミング生成
+            # st.write_streamがトークンを逐次表示し、完成した文字列を返します
+            # プロンプトには直近MAX_HISTORY_TURNSターンの履歴のみを含めます
+            full_prompt = "\n".join(
+                f"{'User' if m['role'] == 'user' else 'AI'}: {m['content']}"
+                for m in st.session_state.messages[-MAX_HISTORY_TURNS:]
+            ) + "\nAI: "
             with st.chat_message("assistant"):
-                st.markdown(response)
-            
+                response = st.write_stream(_throttled_stream(_complete_with_timeout(complete_model, full_prompt, stream=True)))
+
+            # 履歴の更新
+            st.session_state.messages.append({"role": "assistant", "content": response})
+
         except Exception as e:
             st.error(f"応答の生成中にエラーが発生しました: {str(e)}")
 
@@ -131,258 +427,280 @@ def render_rag_chatbot_page():
     * 部署やドキュメントタイプで検索対象を絞り込むことができます
     """)
     
-    # Snowflake Root オブジェクトの初期化
-    root = Root(snowflake_session)
-    
-    # 現在のデータベースとスキーマを取得
-    current_db_schema = snowflake_session.sql("SELECT CURRENT_DATABASE(), CURRENT_SCHEMA()").collect()[0]
-    current_database = current_db_schema['CURRENT_DATABASE()']
-    current_schema = current_db_schema['CURRENT_SCHEMA()']
-    
-    # 部署とドキュメントタイプの取得
+    # 部署とドキュメントタイプの取得（1クエリにまとめてキャッシュ済み）
     try:
-        departments = snowflake_session.sql("""
-            SELECT DISTINCT department FROM snow_retail_documents
-            ORDER BY department
-        """).collect()
-        department_list = [row['DEPARTMENT'] for row in departments]
-        
-        document_types = snowflake_session.sql("""
-            SELECT DISTINCT document_type FROM snow_retail_documents
-            ORDER BY document_type
-        """).collect()
-        document_type_list = [row['DOCUMENT_TYPE'] for row in document_types]
+        department_list, document_type_list = _get_filter_options()
     except Exception as e:
         st.warning("部署とドキュメントタイプの取得に失敗しました。フィルター機能は使用できません。")
         department_list = []
         document_type_list = []
     
     # 検索フィルターの設定
-    with st.expander("検索フィルター設定", expanded=False):
-        col1, col2 = st.columns(2)
-        
-        with col1:
-            selected_departments = st.multiselect(
-                "部署で絞り込み",
-                options=department_list,
-                default=[]
-            )
-        
-        with col2:
-            selected_document_types = st.multiselect(
-                "ドキュメントタイプで絞り込み",
-                options=document_type_list,
-                default=[]
-            )
-    
+    # フラグメント化することで、選択の変更時にページ全体ではなく
+    # このパネルだけが再実行されます（選択内容はセッション状態で共有）
+    @st.fragment
+    def _filter_panel():
+        """検索フィルター設定パネルを表示します。"""
+        with st.expander("検索フィルター設定", expanded=False):
+            col1, col2 = st.columns(2)
+
+            with col1:
+                st.multiselect(
+                    "部署で絞り込み",
+                    options=department_list,
+                    default=[],
+                    key="rag_selected_departments"
+                )
+
+            with col2:
+                st.multiselect(
+                    "ドキュメントタイプで絞り込み",
+                    options=document_type_list,
+                    default=[],
+                    key="rag_selected_document_types"
+                )
+
+    _filter_panel()
+
     # セッション状態の初期化
     if "rag_messages" not in st.session_state:
         st.session_state.rag_messages = []
-        st.session_state.rag_chat_history = ""
     
     # チャット履歴のクリアボタン
     if st.button("チャット履歴をクリア"):
         st.session_state.rag_messages = []
-        st.session_state.rag_chat_history = ""
         st.rerun()
     
     # チャット履歴の表示
-    for message in st.session_state.rag_messages:
-        with st.chat_message(message["role"]):
-            st.markdown(message["content"])
-            if "relevant_docs" in message:
-                with st.expander("参考ドキュメント"):
-                    for doc in message["relevant_docs"]:
-                        st.markdown(f"""
-                        **タイトル**: {doc['title']}  
-                        **種類**: {doc['document_type']}  
-                        **部署**: {doc['department']}  
-                        **内容**: {doc['content']}
-                        """)
+    # フラグメント化により、フィルター操作などではこのビューは再実行されません
+    @st.fragment
+    def _history_view():
+        """チャット履歴を表示します。"""
+        # 参考ドキュメントの全文は最新のメッセージのみ描画し、
+        # それ以前のメッセージはプレビューに切り詰めて再描画コストを抑えます。
+        # 直前の回答と同じドキュメント集合を参照している場合は、
+        # 重複描画を避けて1行の注記にまとめます。
+        doc_cache = st.session_state.get("rag_doc_cache", {})
+        previous_doc_ids = set()
+        last_message_index = len(st.session_state.rag_messages) - 1
+        for i, message in enumerate(st.session_state.rag_messages):
+            with st.chat_message(message["role"]):
+                st.markdown(message["content"])
+                if "doc_ids" in message:
+                    doc_ids = message["doc_ids"]
+                    if i != last_message_index and set(doc_ids) <= previous_doc_ids:
+                        st.caption(f"参考ドキュメント: 直前の回答と同じ {len(doc_ids)}件")
+                    else:
+                        docs = [doc_cache[doc_id] for doc_id in doc_ids if doc_id in doc_cache]
+                        with st.expander(f"参考ドキュメント ({len(docs)}件)"):
+                            for doc in docs:
+                                content = doc['content']
+                                if i != last_message_index and len(content) > HISTORY_DOC_PREVIEW_CHARS:
+                                    content = content[:HISTORY_DOC_PREVIEW_CHARS] + "…（省略）"
+                                st.markdown(f"""
+                                **タイトル**: {doc['title']}
+                                **種類**: {doc['document_type']}
+                                **部署**: {doc['department']}
+                                **内容**: {content}
+                                """)
+                    previous_doc_ids = set(doc_ids)
+
+                # 最新の回答には再生成ボタンを表示
+                # 生成済みの候補間の切り替えはモデルを呼び直さずに行えます
+                if (i == last_message_index and message["role"] == "assistant"
+                        and "gen_prompt" in message):
+                    candidates = message.get("candidates", [])
+                    if len(candidates) > 1:
+                        st.caption(f"回答候補 {message.get('cand_idx', 0) + 1}/{len(candidates)}")
+                    if st.button("🔄 別の回答", key="rag_regenerate"):
+                        _advance_candidate(message)
+                        st.rerun()
     
+
+    _history_view()
+
     # ユーザー入力の処理
-    if prompt := st.chat_input("質問を入力してください"):
-        # ユーザーメッセージの表示と履歴の更新
-        st.session_state.rag_messages.append({"role": "user", "content": prompt})
-        st.session_state.rag_chat_history += f"User: {prompt}\n"
-        with st.chat_message("user"):
-            st.markdown(prompt)
-        
-        try:
-            # Cortex Search Serviceの取得
+    # フラグメント化により、送信時にページ全体を再構築せずに済みます
+    @st.fragment
+    def _chat_input_handler():
+        """ユーザー入力を受け取り、RAGパイプラインで応答を生成します。"""
+        selected_departments = st.session_state.get("rag_selected_departments", [])
+        selected_document_types = st.session_state.get("rag_selected_document_types", [])
+
+        if prompt := st.chat_input("質問を入力してください"):
+            # ユーザーメッセージの表示と履歴の更新
+            st.session_state.rag_messages.append({"role": "user", "content": prompt})
+            with st.chat_message("user"):
+                st.markdown(prompt)
+
+            # セマンティックキャッシュの確認
+            # 類似の質問が過去にあった場合は、検索と回答生成をスキップして再利用します
+            query_embedding = None
+            cached_entry = None
             try:
-                search_service = (
-                    root.databases[current_database]
-                    .schemas[current_schema]
-                    .cortex_search_services["snow_retail_search_service"]
-                )
-                
-                # フィルターの構築
-                filter_conditions = []
-                
-                # 部署フィルターの追加
-                if selected_departments:
-                    dept_conditions = []
-                    for dept in selected_departments:
-                        dept_conditions.append({"@eq": {"department": dept}})
-                    
-                    if len(dept_conditions) == 1:
-                        filter_conditions.append(dept_conditions[0])
-                    else:
-                        filter_conditions.append({"@or": dept_conditions})
-                
-                # ドキュメントタイプフィルターの追加
-                if selected_document_types:
-                    type_conditions = []
-                    for doc_type in selected_document_types:
-                        type_conditions.append({"@eq": {"document_type": doc_type}})
-                    
-                    if len(type_conditions) == 1:
-                        filter_conditions.append(type_conditions[0])
-                    else:
-                        filter_conditions.append({"@or": type_conditions})
-                
-                # 最終的なフィルターの組み立て
-                search_filter = None
-                if filter_conditions:
-                    if len(filter_conditions) == 1:
-                        search_filter = filter_conditions[0]
-                    else:
-                        search_filter = {"@and": filter_conditions}
-                
-                # フィルター情報の表示
-                if selected_departments or selected_document_types:
-                    filter_info = []
-                    if selected_departments:
-                        filter_info.append(f"部署: {', '.join(selected_departments)}")
-                    if selected_document_types:
-                        filter_info.append(f"ドキュメントタイプ: {', '.join(selected_document_types)}")
-                    st.info(f"以下の条件で検索します: {' / '.join(filter_info)}")
-                
-                # 検索の実行（日本語のまま検索）
-                search_args = {
-                    "query": prompt,
-                    "columns": ["title", "chunked_content", "document_type", "department", "document_id"],
-                    "limit": 3
-                }
-                
-                # フィルターがある場合は追加
-                if search_filter:
-                    search_args["filter"] = search_filter
-                
-                search_results = search_service.search(**search_args)
-                
-                # 検索結果から元のドキュメントを取得するためのdocument_idリストを取得
-                document_ids = [result["document_id"] for result in search_results.results]
-                
-                # 重複するdocument_idを排除
-                unique_document_ids = list(set(document_ids))
-                
-                # 元のドキュメントテーブルから完全なCONTENTを取得
-                original_docs_query = f"""
-                    SELECT document_id, title, content, document_type, department
-                    FROM snow_retail_documents
-                    WHERE document_id IN ({','.join(["'" + str(doc_id) + "'" for doc_id in unique_document_ids])})
-                """
-                
-                original_docs_df = snowflake_session.sql(original_docs_query).collect()
-                original_docs = {}
-                
-                # document_idをキーとした辞書を作成
-                for row in original_docs_df:
-                    original_docs[row['DOCUMENT_ID']] = {
-                        "title": row['TITLE'],
-                        "content": row['CONTENT'],
-                        "document_type": row['DOCUMENT_TYPE'],
-                        "department": row['DEPARTMENT']
-                    }
-                
-                # 検索結果とオリジナルドキュメントを組み合わせて関連ドキュメントリストを作成
-                relevant_docs = []
-                seen_doc_ids = set()  # 処理済みのドキュメントIDを記録
-                
-                for result in search_results.results:
-                    doc_id = result["document_id"]
-                    # 既に処理済みのドキュメントIDはスキップ
-                    if doc_id in seen_doc_ids:
-                        continue
-                        
-                    if doc_id in original_docs:
-                        relevant_docs.append({
-                            "title": original_docs[doc_id]["title"],
-                            "content": original_docs[doc_id]["content"],
-                            "chunked_content": result["chunked_content"],  # チャンク化されたコンテンツも保持
-                            "document_type": original_docs[doc_id]["document_type"],
-                            "department": original_docs[doc_id]["department"]
-                        })
-                        seen_doc_ids.add(doc_id)  # 処理済みとしてマーク
-                
-                # 検索結果をコンテキストとして使用（チャンク化されたコンテンツを使用）
-                context = "参考文書:\n"
-                for doc in relevant_docs:
-                    context += f"""
-                    タイトル: {doc['title']}
-                    種類: {doc['document_type']}
-                    部署: {doc['department']}
-                    内容: {doc['chunked_content']}
-                    ---
-                    """
-                
-                # COMPLETEを使用して応答を生成
-                prompt_template = f"""
-                あなたはスノーリテールの社内アシスタントです。
-                以下の文脈を参考に、ユーザーからの質問に日本語で回答してください。
-                わからない場合は、その旨を正直に伝えてください。
+                query_embedding = _embed_text(prompt)
+                cached_entry = _sem_cache_lookup(query_embedding)
+            except Exception:
+                # 埋め込みの取得に失敗した場合は通常のパイプラインで回答を生成
+                pass
 
-                文脈:
-                {context}
+            if cached_entry is not None:
+                response = cached_entry["response"]
+                relevant_docs = cached_entry["relevant_docs"]
 
-                質問: {prompt}
-                """
-                
-                response = CompleteText(complete_model, prompt_template)
-                
-                # アシスタントの応答を表示
+                # キャッシュ済みの応答を表示
                 with st.chat_message("assistant"):
                     st.markdown(response)
                     with st.expander("参考ドキュメント"):
                         for doc in relevant_docs:
                             st.markdown(f"""
-                            **タイトル**: {doc['title']}  
-                            **種類**: {doc['document_type']}  
-                            **部署**: {doc['department']}  
+                            **タイトル**: {doc['title']}
+                            **種類**: {doc['document_type']}
+                            **部署**: {doc['department']}
                             **内容**: {doc['content']}
                             """)
-                
-                # チャット履歴に追加
+
+                # チャット履歴に追加（ドキュメントはプールに登録しIDのみ保持）
                 st.session_state.rag_messages.append({
                     "role": "assistant",
                     "content": response,
-                    "relevant_docs": relevant_docs
+                    "doc_ids": _pool_documents(relevant_docs)
                 })
-                st.session_state.rag_chat_history += f"AI: {response}\n"
+
+                # 履歴ビューを最新化するため全体を再実行
+                st.rerun()
+
+            try:
+                # Cortex Search Serviceの取得（キャッシュ済みのハンドルを再利用）
+                try:
+                    search_service = _get_search_service()
                 
-            except Exception as search_error:
-                st.error(f"Cortex Search Serviceにアクセスできません。ワークショップでCortex Search Serviceが作成されていることを確認してください。")
-                st.code(str(search_error))
+                    # フィルターの構築（同じ選択の組み合わせはキャッシュから返却）
+                    # 未指定の場合は構築もフィルター情報の表示もスキップします
+                    filters_active = bool(selected_departments or selected_document_types)
+                    search_filter = None
+                    if filters_active:
+                        search_filter = _build_filter(
+                            tuple(selected_departments),
+                            tuple(selected_document_types)
+                        )
+
+                    # 検索の実行（日本語のまま検索）
+                    search_args = {
+                        "query": prompt,
+                        "columns": ["title", "chunked_content", "content", "document_type", "department", "document_id"],
+                        "limit": RERANK_CANDIDATES
+                    }
+
+                    # フィルターがある場合は追加
+                    if search_filter:
+                        search_args["filter"] = search_filter
+
+                    # 検索をワーカースレッドに投げ、待っている間にUIの更新を進めます
+                    search_future = _get_executor().submit(search_service.search, **search_args)
+
+                    # フィルター情報の表示（検索の完了を待たずに描画）
+                    if filters_active:
+                        filter_info = []
+                        if selected_departments:
+                            filter_info.append(f"部署: {', '.join(selected_departments)}")
+                        if selected_document_types:
+                            filter_info.append(f"ドキュメントタイプ: {', '.join(selected_document_types)}")
+                        st.info(f"以下の条件で検索します: {' / '.join(filter_info)}")
+
+                    # アシスタントのコンテナはターンの開始時に1つだけ開き、
+                    # 検索待ちからストリーミング、参考ドキュメントの表示まで
+                    # 同じコンテナに書き込みます（ストリーム完了後の再マウントなし）
+                    with st.chat_message("assistant"):
+                        with st.spinner("関連ドキュメントを検索中..."):
+                            search_results = search_future.result()
+
+                            # 候補を質問との類似度でリランキングし、上位のみを採用
+                            reranked_results = _rerank_results(prompt, search_results.results)
+
+                            # 検索結果から関連ドキュメントリストを作成
+                            # 完全なCONTENTもCortex Searchから直接取得するため、
+                            # ドキュメントテーブルへの追加クエリは不要です。
+                            # 辞書の挿入順序を利用して、検索結果の順序を保ったまま
+                            # document_idの重複を1パスで排除します
+                            results_by_doc_id = {}
+                            for result in reranked_results:
+                                results_by_doc_id.setdefault(result["document_id"], result)
+
+                            relevant_docs = [
+                                {
+                                    "document_id": doc_id,
+                                    "title": result["title"],
+                                    "content": result["content"],
+                                    "chunked_content": result["chunked_content"],  # チャンク化されたコンテンツも保持
+                                    "document_type": result["document_type"],
+                                    "department": result["department"]
+                                }
+                                for doc_id, result in results_by_doc_id.items()
+                            ]
+
+                            # 検索結果をコンテキストとして使用（チャンク化されたコンテンツを使用）
+                            # 文字列の+=を繰り返す代わりにjoinで一括結合します
+                            context = "参考文書:\n" + "".join(
+                                RAG_DOC_FORMAT.format(**doc) for doc in relevant_docs
+                            )
+
+                            # COMPLETEを使用して応答を生成
+                            prompt_template = RAG_PROMPT_TEMPLATE.format(context=context, prompt=prompt)
+
+                        # アシスタントの応答をストリーミング表示
+                        response = st.write_stream(_throttled_stream(_complete_with_timeout(complete_model, prompt_template, stream=True)))
+                        with st.expander("参考ドキュメント"):
+                            for doc in relevant_docs:
+                                st.markdown(f"""
+                                **タイトル**: {doc['title']}  
+                                **種類**: {doc['document_type']}  
+                                **部署**: {doc['department']}  
+                                **内容**: {doc['content']}
+                                """)
                 
-                # 代わりに通常のCOMPLETE関数で回答を生成
-                fallback_response = CompleteText(complete_model, f"以下の質問に日本語で回答してください。社内文書にアクセスできないため、一般的な知識に基づいて回答します。\n\n質問: {prompt}")
+                    # チャット履歴に追加（ドキュメントはプールに登録しIDのみ保持）
+                    st.session_state.rag_messages.append({
+                        "role": "assistant",
+                        "content": response,
+                        "doc_ids": _pool_documents(relevant_docs),
+                        "gen_prompt": prompt_template
+                    })
+
+                    # 次回以降の類似質問のためにセマンティックキャッシュへ追加
+                    if query_embedding is not None:
+                        _sem_cache_store(query_embedding, prompt, response, relevant_docs)
+
+                    # 履歴ビューを最新化するため全体を再実行
+                    st.rerun()
+
+                except Exception as search_error:
+                    st.error(f"Cortex Search Serviceにアクセスできません。ワークショップでCortex Search Serviceが作成されていることを確認してください。")
+                    st.code(str(search_error))
                 
-                with st.chat_message("assistant"):
-                    st.markdown(fallback_response)
-                    st.info("注: Cortex Search Serviceにアクセスできないため、一般的な知識に基づく回答を生成しています。")
+                    # 代わりに通常のCOMPLETE関数で回答をストリーミング生成
+                    fallback_prompt = f"以下の質問に日本語で回答してください。社内文書にアクセスできないため、一般的な知識に基づいて回答します。\n\n質問: {prompt}"
+
+                    with st.chat_message("assistant"):
+                        fallback_response = st.write_stream(_throttled_stream(_complete_with_timeout(complete_model, fallback_prompt, stream=True)))
+                        st.info("注: Cortex Search Serviceにアクセスできないため、一般的な知識に基づく回答を生成しています。")
                 
-                # チャット履歴に追加
-                st.session_state.rag_messages.append({
-                    "role": "assistant",
-                    "content": fallback_response
-                })
-                st.session_state.rag_chat_history += f"AI: {fallback_response}\n"
-            
-        except Exception as e:
-            st.error(f"応答の生成中にエラーが発生しました: {str(e)}")
-            st.code(str(e)) 
+                    # チャット履歴に追加
+                    st.session_state.rag_messages.append({
+                        "role": "assistant",
+                        "content": fallback_response,
+                        "gen_prompt": fallback_prompt
+                    })
+
+                    # 履歴ビューを最新化するため全体を再実行
+                    st.rerun()
+
+            except Exception as e:
+                st.error(f"応答の生成中にエラーが発生しました: {str(e)}")
+                st.code(str(e)) 
+
+    _chat_input_handler()
+
 
 # =========================================================
 # メイン処理